@@ -0,0 +1,135 @@
+"""
+Normalisation of dataset metadata and variable attributes into wide tables, one row per dataset.
+
+String attributes holding Python literals (e.g. the sensor dictionaries) are parsed with ast.literal_eval, and
+the result is memoised as the same strings repeat across datasets. Rows are flattened to dicts and the table is
+built column by column in a single pass, with the dtype of each column inferred from its values. Flattening can
+optionally be spread over a process pool, but this gives almost no speedup: the attributes are parsed and copied in
+the parent process, so the workers only run the cheap flattening and the rows still have to be sent back.
+"""
+import ast
+import copy
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import numpy as np
+
+
+@lru_cache(maxsize=4096)
+def _literal(val):
+    try:
+        return ast.literal_eval(val)
+    except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+        return val
+
+
+def parse_attribute(val):
+    """
+    Evaluate a string attribute containing a Python literal, such as "{'make': 'RBR', 'serial': '66'}".
+    Strings that are not valid literals are returned unchanged
+    """
+    # Copy so that callers modifying the result do not alter the memoised value
+    return copy.deepcopy(_literal(val))
+
+
+def flatten_meta(meta):
+    """
+    Flatten the metadata of a dataset, as returned by voto_erddap_utils.get_meta, into a row dict.
+    Dictionaries are expanded one level into key_subkey columns. A nested dictionary is expanded into
+    subkey_subsubkey columns instead
+    """
+    row = {}
+    for key, val in meta.items():
+        # If the value is a method (like dataset.close) do not include it
+        if callable(val):
+            continue
+        if type(val) is dict:
+            for k, v in val.items():
+                if type(v) is dict:
+                    for c, u in v.items():
+                        row[f'{k}_{c}'] = u
+                else:
+                    row[f'{key}_{k}'] = v
+        elif type(val) is str:
+            row[key] = val.replace("\n", "")
+        elif type(val) is list:
+            row[key] = str(val)
+        else:
+            row[key] = val
+    return row
+
+
+def flatten_var_attrs(var_attrs):
+    """
+    Flatten the attributes of every variable of a dataset into a row dict of variable_attribute columns.
+    var_attrs: dict of attribute dicts keyed by variable name
+    All values are stored as their string representation
+    """
+    return {f'{var_name}_{key}': str(val) for var_name, attrs in var_attrs.items() for key, val in attrs.items()}
+
+
+def _is_int(val):
+    return isinstance(val, (int, np.integer)) and not isinstance(val, bool)
+
+
+def _infer_column(values):
+    # Mirror the dtypes pandas would give when concatenating single row tables: missing values become nan,
+    # which turns integer columns into floats and boolean columns into objects
+    present = [val for val in values if val is not None]
+    missing = len(present) < len(values)
+    if present and all(isinstance(val, (bool, np.bool_)) for val in present):
+        if not missing:
+            return np.array(values, dtype=bool)
+    elif present and all(_is_int(val) for val in present) and not missing:
+        return np.array(values, dtype=np.int64)
+    elif present and all(_is_int(val) or isinstance(val, (float, np.floating)) for val in present):
+        return np.array([np.nan if val is None else val for val in values], dtype=float)
+    # Filled element by element so that array values are not broadcast
+    column = np.empty(len(values), dtype=object)
+    for i, val in enumerate(values):
+        column[i] = np.nan if val is None else val
+    return column
+
+
+def build_table(rows, index):
+    """
+    Build a wide table from a list of row dicts. Columns appear in the order they are first found and cells
+    missing from a row are nan
+    """
+    import pandas as pd
+    columns = {}
+    for i, row in enumerate(rows):
+        for key, val in row.items():
+            if key not in columns:
+                columns[key] = [None] * len(rows)
+            columns[key][i] = val
+    return pd.DataFrame({key: _infer_column(values) for key, values in columns.items()}, index=pd.Index(index))
+
+
+def _flatten(func, items, processes):
+    if not processes or len(items) < 2:
+        return [func(item) for item in items]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        return list(pool.map(func, items, chunksize=max(1, len(items) // (4 * processes))))
+
+
+def metadata_table(ds_meta, processes=None):
+    """
+    Build the metadata table.
+    ds_meta: dict of dataset metadata, as returned by voto_erddap_utils.get_meta, keyed by datasetID
+    processes: number of worker processes used to flatten the rows. If None, rows are flattened in this process.
+    The metadata is already parsed by get_meta, so a pool gives almost no speedup
+    """
+    # Methods (like dataset.close) are dropped up front as they cannot be sent to worker processes
+    metas = [{key: val for key, val in meta.items() if not callable(val)} for meta in ds_meta.values()]
+    return build_table(_flatten(flatten_meta, metas, processes), ds_meta.keys())
+
+
+def var_attrs_table(datasets, processes=None):
+    """
+    Build the table of variable attributes.
+    datasets: dict of datasets keyed by datasetID
+    processes: number of worker processes used to flatten the rows. If None, rows are flattened in this process.
+    The attributes are copied out of the datasets in this process, so a pool gives almost no speedup
+    """
+    var_attrs = [{var_name: dict(ds[var_name].attrs) for var_name in ds.data_vars} for ds in datasets.values()]
+    return build_table(_flatten(flatten_var_attrs, var_attrs, processes), datasets.keys())
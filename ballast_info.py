@@ -1,14 +1,20 @@
-from erddapy import ERDDAP
+import json
 from pathlib import Path
 import numpy as np
 import pandas as pd
+import ballast_stats
 import voto_erddap_utils as utils
-import matplotlib.pyplot as plt
 
+ballast_variables = ('ballast_pos', 'time', 'dive_num', 'ballast_cmd', 'nav_state', 'security_level')
+# depth is returned by the server alongside the requested variables and is used for the max depth
+_ballast_view_variables = ballast_variables + ('depth',)
 
-def get_glider_dataset_ids():
-    e = ERDDAP(server="https://erddap.observations.voiceoftheocean.org/erddap",
-               protocol="tabledap")
+
+def get_glider_dataset_ids(catalog=None):
+    if catalog is not None:
+        df_datasets = pd.Series(catalog.index)
+        return df_datasets[df_datasets.str.contains("SEA")]
+    e = utils.init_erddap()
 
     e.dataset_id = "allDatasets"
     df_datasets = e.to_pandas()['datasetID']
@@ -16,14 +22,15 @@ def get_glider_dataset_ids():
     return df_glider_datasets
 
 
-def select_datasets(glider_serial=None, mission_num=None, data_type='nrt'):
+def select_datasets(glider_serial=None, mission_num=None, data_type='nrt', catalog=None):
     '''
     inputs:
     glider_serial= xx
     data_type= 'nrt' or 'delayed'
+    catalog= optional table of all datasets indexed by datasetID. Fetched from the server if not supplied
     '''
 
-    df_datasets = get_glider_dataset_ids()
+    df_datasets = get_glider_dataset_ids(catalog=catalog)
     if glider_serial:
         glider_num = str(glider_serial).zfill(3)
         df_datasets = df_datasets[df_datasets.str.contains(f"SEA{glider_num}")]
@@ -37,144 +44,127 @@ def select_datasets(glider_serial=None, mission_num=None, data_type='nrt'):
     return df_datasets.values
 
 
-def ballast_info(glider_datasets, threshold=420, noise_threshold=5):
+def _iter_chunks(ds, chunk_size):
+    # Slicing a dataset opened from disk only reads the requested samples
+    for start in range(0, ds.sizes["time"], chunk_size):
+        yield ds.isel(time=slice(start, start + chunk_size))
+
+
+def accumulate_ballast(ds, threshold=420, noise_threshold=5, chunk_size=100000, start=0):
+    '''
+    Compute the ballast statistics of a dataset chunk by chunk.
+    start= index of the first sample of ds from the start of the mission. Use the sample count of an existing accumulator when ds only contains appended data
+    Returns a ballast_stats.BallastAccumulator
+    '''
+    acc = ballast_stats.BallastAccumulator(threshold=threshold, noise_threshold=noise_threshold, start=start)
+    for chunk in _iter_chunks(ds, chunk_size):
+        acc.update(chunk)
+    return acc
+
+
+def _ballast_row(name, acc, attrs):
+    row = {'datasetID': name, 'deployment_id': attrs['deployment_id'], 'glider_serial': attrs['glider_serial']}
+    row.update(acc.result())
+    row['basin'] = attrs.get('basin', "")
+    return row
+
+
+def _state_file(dataset_id):
+    return utils.cache_dir / "ballast_state" / f"{dataset_id}.json"
+
+
+def _save_state(dataset_id, acc, attrs):
+    state_file = _state_file(dataset_id)
+    state_file.parent.mkdir(parents=True, exist_ok=True)
+    attrs = {key: attrs[key] for key in ('deployment_id', 'glider_serial', 'basin') if key in attrs}
+    with open(state_file, 'w') as file:
+        json.dump({'attrs': attrs, 'accumulator': acc.to_dict()}, file, default=str)
+
+
+def _load_state(dataset_id):
+    state_file = _state_file(dataset_id)
+    if not state_file.exists():
+        return None, None
+    with open(state_file) as file:
+        state = json.load(file)
+    return ballast_stats.BallastAccumulator.from_dict(state['accumulator']), state['attrs']
+
+
+def ballast_info(glider_datasets, threshold=420, noise_threshold=5, planner=None, chunk_size=100000):
     '''
     threshold= xxx value in ml. Number of times glider pumps crosses positively
     noise_threshold= xx ml, minimum difference between two consequetive points in ballast position to be accounted for in calculating total active pumping during mission. To not account for noise in ballast pumping calculations.
+    planner= optional RequestPlanner. If supplied, datasets are taken from the planner instead of being downloaded. The datasets must have been declared to the planner beforehand
+    chunk_size= number of samples processed at a time. Cached datasets are read from disk one chunk at a time
+
+    The accumulated statistics of each mission are saved next to the dataset cache so that update_ballast_info can later process only newly appended samples
     '''
     
-    ds_dict = utils.download_glider_dataset(glider_datasets, nrt_only=False, variables=(['ballast_pos', 'time', 'dive_num', 'ballast_cmd', 'nav_state', 'security_level']))
-    #Max, min, and total pumping + max depth values for the full mission
-    max_ballast=[]
-    min_ballast=[]
-    total_dives = []
-    total_pump= []
-    max_depth=[]
-    
-    #Average variables based on each dive in every mission. Range is average range per mission. Upper limit is based off nav state 117
-    avg_pump_max =[]
-    avg_pump_min =[]
-    avg_pump_range=[]
-    std_pump_max=[]
-    std_pump_min=[]
-    
-    #For the amount of points above threshold which is specified below, not sure if this information is actually usable
-    high_volume=[]
-    percent_high_volume=[]
-    
-    #For mission name and basin name
-    ds_name=[]
-    basin=[]
-    mission_no=[]
-    glider_serial=[]
-    
-    #Which extreme value to check high pumping volumes and create array to how many times crossed over for each mission
-    cross_over_threshold=[]
-    threshold_value=[]
-    
-    for name, ds in ds_dict.items():
-    
-        #Max and min ballast values per mission and total dives + total volume pumped for mission
-        max_ballast.append(np.nanmax(ds.ballast_pos))
-        min_ballast.append(np.nanmin(ds.ballast_pos))
-        total_dives.append(ds['dive_num'].values.max())
+    if planner is None:
+        ds_dict = utils.download_glider_dataset(glider_datasets, nrt_only=False, variables=list(ballast_variables))
+    else:
+        ds_dict = planner.views(glider_datasets, variables=_ballast_view_variables)
 
-        max_depth.append(int(np.nanmax(np.abs(ds.depth))))
-        
-        if np.diff(ds.time).mean()/ np.timedelta64(1, 's')<0.8:
-            test=ds.thin({"time": 70}) #.isel(obs=ds.dive_num==528)
-        else:
-            test=ds.thin({"time": 15}) #.isel(obs=ds.dive_num==528)
-        ballast = test.isel(time=np.isfinite(test.ballast_pos.values))
-        ballast= ballast.isel(time=np.isfinite(ballast.ballast_cmd.values))
-        
-        pos=ballast.ballast_pos.values
-        cmd = ballast.ballast_cmd.values
-        
-        pos_pre = pos.copy()[:-1]
-        pos_post = pos.copy()[1:]
-        pos_diff = pos_post - pos_pre
-        
-        cmd_pre = cmd.copy()[:-1]
-        cmd_post = cmd.copy()[1:]
-        cmd_diff = cmd_post - cmd_pre
-
-        pos_pump_vol=np.where((pos_diff)>noise_threshold, pos_diff, 0)
-        
-        total_pump.append(int(np.sum(pos_pump_vol)))
-
-        #Average max and min pumping
-        ballast_top_range=[]
-        ballast_low_range=[]
-
-        # crossover
-        ballast = ds.ballast_pos.values
-        ballast = ballast[~np.isnan(ballast)]
-        ballast_pre = ballast.copy()[:-1]
-        ballast_post = ballast.copy()[1:]
-        ballast_pre[ballast_pre > threshold] = np.nan
-        ballast_post[ballast_post < threshold] = np.nan
-        ballast_diff = ballast_post - ballast_pre
-        cross_over = sum(ballast_diff > 0)
-
-        #Create array of divenumbers in order for nrt datasets as all dives are not available. Remove duplicates and sort them
-        dive_num=np.sort(np.array(list(set(ds.dive_num.values))))
-        for i in dive_num:
-            ds_dive=ds.sel(time=ds.dive_num==i)
-
-            ds_nav_state=ds_dive.sel(time=ds_dive.nav_state==117) #Select data for navstate 117 only (Glider going up) to avoid ballast surfacing values
-        
-            if len(ds_dive.sel(time=ds_dive.security_level>0).time) >0: #If there are alarms at this dive, do not include this in avg pumping max or min range
-                ballast_top_range.append(np.nan)
-                ballast_low_range.append(np.nan)
-                
-            elif len(ds_nav_state.time)>0:
-                ballast_top_range.append(int(ds_nav_state.ballast_pos.values.max()))
-                ballast_low_range.append(int(ds_dive.ballast_pos.values.min()))
-            else:
-                ballast_top_range.append(np.nan) #As there are so few dives with no navstate 117, add nans for these TO BE REVISED
-                ballast_low_range.append(int(ds_dive.ballast_pos.values.min()))
-
-        #Calculate average pumping range
-        pump_range= np.array(ballast_top_range) - np.array(ballast_low_range)
-        avg_pump_max.append(int(np.nanmean(ballast_top_range)))
-        avg_pump_min.append(int(np.nanmean(ballast_low_range)))
-        avg_pump_range.append(int(np.nanmean(pump_range)))
-    
-        std_pump_max.append(int(np.nanstd(ballast_top_range)))
-        std_pump_min.append(int(np.nanstd(ballast_low_range)))
-    
-        #How often is the volume over threshold
-        cross_over_threshold.append(int(cross_over)) #How many times over the whole mission it crossed over threshold value
-        threshold_value.append(threshold)
-        
-        # Add string categories: Basin and Mission name & number
-        try:
-            basin.append(ds.basin)
-        except:
-            basin.append("")
-        ds_name.append(name)
-        mission_no.append(ds.deployment_id)
-        glider_serial.append(ds.glider_serial)
-    
-    #Make all values integers
-    total_dives=np.array(total_dives).astype(int)
-    max_ballast=np.array(max_ballast).astype(int)
-    min_ballast=np.array(min_ballast).astype(int)
-    total_dives=np.array(total_dives).astype(int)
-    avg_pump_max=np.array(avg_pump_max).astype(int)
-    avg_pump_min=np.array(avg_pump_min).astype(int)
-    high_volume=np.array(high_volume).astype(int)
-
-   
-    df_pumps = pd.DataFrame({'datasetID': ds_name, 'deployment_id': mission_no, 'glider_serial': glider_serial,
-                             'total dives': total_dives, 'max depth (m)': max_depth, 'max ballast (ml)': max_ballast, 'min ballast (ml)': min_ballast, 'avg max pumping value (ml)': avg_pump_max,
-                             'std_max': std_pump_max, 'std_min': std_pump_min , 'avg min pumping value (ml)': avg_pump_min, 'avg pumping range (ml)': avg_pump_range, 'total active pumping (ml)': total_pump, 
-                             'times crossing over '+str(threshold)+' ml': cross_over_threshold, 'basin': basin, 'threshold': threshold_value } )
-    #'datapoints over '+str(threshold)+' ml': high_volume, 'Ballast positions over '+str(threshold)+' ml (%)' :percent_high_volume,
+    rows = []
+    for name, ds in ds_dict.items():
+        acc = accumulate_ballast(ds, threshold=threshold, noise_threshold=noise_threshold, chunk_size=chunk_size)
+        _save_state(name, acc, ds.attrs)
+        rows.append(_ballast_row(name, acc, ds.attrs))
+    df_pumps = pd.DataFrame(rows, columns=_ballast_columns(threshold))
     return df_pumps
 
 
+def _state_matches(ds, acc):
+    # The saved statistics only apply if the samples they were computed from are still the start of the mission
+    time = ds.time.values
+    last_time = np.datetime64(acc.last_time, 'ns')
+    return (time[0] == np.datetime64(acc.first_time, 'ns') and (time == last_time).any()
+            and (time <= last_time).sum() == acc.start + acc.count)
+
+
+def update_ballast_info(dataset_id, threshold=420, noise_threshold=5, chunk_size=100000, planner=None):
+    '''
+    Update the ballast info of a live nrt mission, processing only the samples added since it was last computed.
+    The whole mission is processed instead, overwriting the saved statistics, if the mission is not nrt, if no saved statistics exist for these thresholds, or if the already processed samples have changed (removed, or arrived late).
+    planner= optional RequestPlanner the mission has been declared to. If supplied, the new samples are taken from it instead of being downloaded. Without a planner only samples after the last processed time are downloaded, so changes to the already processed samples cannot be detected, nor a failed download told apart from a mission without new data
+    Returns a table with the updated row, or an empty table if the mission failed to download
+    '''
+    acc, attrs = _load_state(dataset_id)
+    if (not dataset_id.startswith('nrt') or acc is None
+            or (acc.threshold, acc.noise_threshold) != (threshold, noise_threshold)):
+        return ballast_info([dataset_id], threshold=threshold, noise_threshold=noise_threshold, planner=planner,
+                            chunk_size=chunk_size)
+    if planner is None:
+        last_time = pd.to_datetime(acc.last_time, utc=True).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        # An empty result is reported by the server as an error, in which case there is no new data
+        ds_dict = utils.download_glider_dataset([dataset_id], variables=list(ballast_variables),
+                                                constraints={'time>': last_time}, cache_datasets=False)
+    else:
+        ds_dict = planner.views([dataset_id], variables=_ballast_view_variables)
+        ds = ds_dict.get(dataset_id)
+        if ds is None:
+            # Failed download, reported like in ballast_info by leaving the mission out of the table
+            return pd.DataFrame(columns=_ballast_columns(threshold))
+        if ds.sizes['time'] and not _state_matches(ds, acc):
+            # The mission has been reprocessed or samples were backfilled, the saved statistics no longer apply
+            return ballast_info([dataset_id], threshold=threshold, noise_threshold=noise_threshold,
+                                planner=planner, chunk_size=chunk_size)
+    if dataset_id in ds_dict:
+        ds = ds_dict[dataset_id]
+        ds = ds.isel(time=ds.time.values > np.datetime64(acc.last_time, 'ns'))
+        acc = acc.merge(accumulate_ballast(ds, threshold=threshold, noise_threshold=noise_threshold,
+                                           chunk_size=chunk_size, start=acc.start + acc.count))
+        _save_state(dataset_id, acc, attrs)
+    return pd.DataFrame([_ballast_row(dataset_id, acc, attrs)], columns=_ballast_columns(threshold))
+
+
+def _ballast_columns(threshold):
+    return ['datasetID', 'deployment_id', 'glider_serial', 'total dives', 'max depth (m)', 'max ballast (ml)',
+            'min ballast (ml)', 'avg max pumping value (ml)', 'std_max', 'std_min', 'avg min pumping value (ml)',
+            'avg pumping range (ml)', 'total active pumping (ml)', 'times crossing over '+str(threshold)+' ml',
+            'basin', 'threshold']
+
+
 def ballast_plots(df_pumps):
     '''
     input: table generated by ballast_info
@@ -183,6 +173,8 @@ def ballast_plots(df_pumps):
     Generates plot of avg. pumping range and twinaxis with number of dives in mission and times ballast volume crossed from below threshold to above
     
     '''
+    # matplotlib is only needed for plotting, so headless table jobs do not pay for importing it
+    import matplotlib.pyplot as plt
 
     threshold=df_pumps['threshold'][0]
     
@@ -0,0 +1,350 @@
+"""
+Streaming accumulators for the ballast statistics reported by ballast_info.
+
+Each accumulator is fed a mission chunk by chunk, in time order, and carries the state needed at chunk boundaries
+(the last valid sample, the dives still open, ...) so that the result is identical to processing the whole
+mission at once. Accumulators covering consecutive stretches of a mission can be merged, which allows a live
+mission's ballast row to be updated by processing only the newly appended samples.
+"""
+import numpy as np
+
+# Ballast positions are thinned before summing the pumped volume. The thinning step depends on the mean sampling
+# interval of the whole mission, which is only known at the end, so both candidates are accumulated
+fast_sampling_interval = 0.8  # s
+thin_step_fast = 70
+thin_step_slow = 15
+
+
+def _nan_to_none(value):
+    return None if value is None or np.isnan(value) else float(value)
+
+
+def _none_to_nan(value):
+    return np.nan if value is None else value
+
+
+class ExtremaAccumulator:
+    """
+    Running nan-ignoring maximum and minimum
+    """
+
+    def __init__(self):
+        self.max = np.nan
+        self.min = np.nan
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        if np.isnan(values).all():
+            return
+        self.max = np.fmax(self.max, np.nanmax(values))
+        self.min = np.fmin(self.min, np.nanmin(values))
+
+    def merge(self, other):
+        merged = ExtremaAccumulator()
+        merged.max = np.fmax(self.max, other.max)
+        merged.min = np.fmin(self.min, other.min)
+        return merged
+
+    def to_dict(self):
+        return {"max": _nan_to_none(self.max), "min": _nan_to_none(self.min)}
+
+    @classmethod
+    def from_dict(cls, state):
+        acc = cls()
+        acc.max = _none_to_nan(state["max"])
+        acc.min = _none_to_nan(state["min"])
+        return acc
+
+
+class PumpVolumeAccumulator:
+    """
+    Total volume pumped, as the sum of the increases in ballast position larger than noise_threshold between
+    consecutive points of the thinned series. Points are kept every `step` samples, counted from the start of the
+    mission, and only where both ballast_pos and ballast_cmd are finite
+    """
+
+    def __init__(self, step, noise_threshold=5):
+        self.step = step
+        self.noise_threshold = noise_threshold
+        self.first = None
+        self.last = None
+        self.total = 0.0
+
+    def _add_diffs(self, diffs):
+        diffs = np.asarray(diffs, dtype=float)
+        self.total += float(np.sum(diffs[diffs > self.noise_threshold]))
+
+    def update(self, pos, cmd, start):
+        """
+        pos, cmd: ballast_pos and ballast_cmd of the chunk
+        start: index of the first sample of the chunk from the start of the mission
+        """
+        pos = np.asarray(pos, dtype=float)
+        cmd = np.asarray(cmd, dtype=float)
+        keep = (start + np.arange(len(pos))) % self.step == 0
+        pos = pos[keep]
+        pos = pos[np.isfinite(pos) & np.isfinite(cmd[keep])]
+        if len(pos) == 0:
+            return
+        if self.last is not None:
+            self._add_diffs([pos[0] - self.last])
+        self._add_diffs(np.diff(pos))
+        if self.first is None:
+            self.first = float(pos[0])
+        self.last = float(pos[-1])
+
+    def merge(self, other):
+        merged = PumpVolumeAccumulator(self.step, self.noise_threshold)
+        merged.total = self.total + other.total
+        if self.last is not None and other.first is not None:
+            merged._add_diffs([other.first - self.last])
+        merged.first = self.first if self.first is not None else other.first
+        merged.last = other.last if other.last is not None else self.last
+        return merged
+
+    def to_dict(self):
+        return {"step": self.step, "noise_threshold": self.noise_threshold, "first": self.first,
+                "last": self.last, "total": self.total}
+
+    @classmethod
+    def from_dict(cls, state):
+        acc = cls(state["step"], state["noise_threshold"])
+        acc.first = state["first"]
+        acc.last = state["last"]
+        acc.total = state["total"]
+        return acc
+
+
+class CrossoverAccumulator:
+    """
+    Number of times consecutive non-nan ballast positions go from at or below threshold to at or above it
+    """
+
+    def __init__(self, threshold=420):
+        self.threshold = threshold
+        self.first = None
+        self.last = None
+        self.count = 0
+
+    def _crossings(self, pre, post):
+        return int(np.sum((pre <= self.threshold) & (post >= self.threshold) & (post > pre)))
+
+    def update(self, pos):
+        pos = np.asarray(pos, dtype=float)
+        pos = pos[~np.isnan(pos)]
+        if len(pos) == 0:
+            return
+        if self.last is not None:
+            self.count += self._crossings(np.array([self.last]), pos[:1])
+        self.count += self._crossings(pos[:-1], pos[1:])
+        if self.first is None:
+            self.first = float(pos[0])
+        self.last = float(pos[-1])
+
+    def merge(self, other):
+        merged = CrossoverAccumulator(self.threshold)
+        merged.count = self.count + other.count
+        if self.last is not None and other.first is not None:
+            merged.count += merged._crossings(np.array([self.last]), np.array([other.first]))
+        merged.first = self.first if self.first is not None else other.first
+        merged.last = other.last if other.last is not None else self.last
+        return merged
+
+    def to_dict(self):
+        return {"threshold": self.threshold, "first": self.first, "last": self.last, "count": self.count}
+
+    @classmethod
+    def from_dict(cls, state):
+        acc = cls(state["threshold"])
+        acc.first = state["first"]
+        acc.last = state["last"]
+        acc.count = state["count"]
+        return acc
+
+
+class DiveRangeAccumulator:
+    """
+    Per-dive pumping range. For every dive, tracks the maximum ballast position while going up (nav_state 117),
+    the minimum ballast position, and whether any alarm (security_level > 0) was raised. Dives may span several
+    chunks
+    """
+
+    def __init__(self):
+        # dive_num -> [top, low, alarm, going_up]
+        self.dives = {}
+
+    def update(self, dive_num, nav_state, security_level, pos):
+        dive_num = np.asarray(dive_num, dtype=float)
+        valid = ~np.isnan(dive_num)
+        dive_num = dive_num[valid]
+        if len(dive_num) == 0:
+            return
+        going_up = np.asarray(nav_state)[valid] == 117
+        alarm = np.asarray(security_level)[valid] > 0
+        pos = np.asarray(pos, dtype=float)[valid]
+        dives, inverse = np.unique(dive_num, return_inverse=True)
+        top = np.full(len(dives), np.nan)
+        low = np.full(len(dives), np.nan)
+        np.fmax.at(top, inverse[going_up], pos[going_up])
+        np.fmin.at(low, inverse, pos)
+        has_alarm = np.bincount(inverse, weights=alarm.astype(float), minlength=len(dives)) > 0
+        has_up = np.bincount(inverse, weights=going_up.astype(float), minlength=len(dives)) > 0
+        for i, dive in enumerate(dives.tolist()):
+            self._add(dive, [top[i], low[i], bool(has_alarm[i]), bool(has_up[i])])
+
+    def _add(self, dive, stats):
+        if dive not in self.dives:
+            self.dives[dive] = stats
+            return
+        top, low, alarm, going_up = self.dives[dive]
+        self.dives[dive] = [np.fmax(top, stats[0]), np.fmin(low, stats[1]), alarm or stats[2], going_up or stats[3]]
+
+    def merge(self, other):
+        merged = DiveRangeAccumulator()
+        for dives in (self.dives, other.dives):
+            for dive, stats in dives.items():
+                merged._add(dive, list(stats))
+        return merged
+
+    def ranges(self):
+        """
+        Returns arrays of the top and low pumping values of every dive. Dives with alarms are excluded (nan), as
+        is the top value of dives without a nav_state 117 phase
+        """
+        top_range = []
+        low_range = []
+        for dive in sorted(self.dives):
+            top, low, alarm, going_up = self.dives[dive]
+            if alarm:
+                top_range.append(np.nan)
+                low_range.append(np.nan)
+            elif going_up:
+                top_range.append(np.trunc(top))
+                low_range.append(np.trunc(low))
+            else:
+                top_range.append(np.nan)
+                low_range.append(np.trunc(low))
+        return np.array(top_range), np.array(low_range)
+
+    def to_dict(self):
+        return {"dives": [[dive, _nan_to_none(top), _nan_to_none(low), alarm, going_up]
+                          for dive, (top, low, alarm, going_up) in self.dives.items()]}
+
+    @classmethod
+    def from_dict(cls, state):
+        acc = cls()
+        for dive, top, low, alarm, going_up in state["dives"]:
+            acc.dives[dive] = [_none_to_nan(top), _none_to_nan(low), alarm, going_up]
+        return acc
+
+
+class BallastAccumulator:
+    """
+    All ballast statistics of a mission, fed chunk by chunk in time order.
+    threshold: value in ml used to count crossovers
+    noise_threshold: minimum increase in ml between thinned points to be counted as active pumping
+    start: index of the first sample this accumulator will receive, counted from the start of the mission.
+        Set it to the sample count of an existing accumulator to process appended data separately
+    """
+
+    def __init__(self, threshold=420, noise_threshold=5, start=0):
+        self.threshold = threshold
+        self.noise_threshold = noise_threshold
+        self.start = start
+        self.count = 0
+        self.first_time = None
+        self.last_time = None
+        self.ballast = ExtremaAccumulator()
+        self.depth = ExtremaAccumulator()
+        self.dive_num = ExtremaAccumulator()
+        self.pump = {step: PumpVolumeAccumulator(step, noise_threshold) for step in (thin_step_fast, thin_step_slow)}
+        self.crossover = CrossoverAccumulator(threshold)
+        self.dive_range = DiveRangeAccumulator()
+
+    def update(self, chunk):
+        """
+        chunk: xarray Dataset or dict of arrays with time, ballast_pos, ballast_cmd, dive_num, nav_state,
+        security_level and depth, sorted by time
+        """
+        time = np.asarray(chunk["time"]).astype("datetime64[ns]").astype(np.int64)
+        if len(time) == 0:
+            return
+        pos = np.asarray(chunk["ballast_pos"], dtype=float)
+        self.ballast.update(pos)
+        self.depth.update(np.abs(np.asarray(chunk["depth"], dtype=float)))
+        self.dive_num.update(chunk["dive_num"])
+        for pump in self.pump.values():
+            pump.update(pos, chunk["ballast_cmd"], self.start + self.count)
+        self.crossover.update(pos)
+        self.dive_range.update(chunk["dive_num"], chunk["nav_state"], chunk["security_level"], pos)
+        if self.first_time is None:
+            self.first_time = int(time[0])
+        self.last_time = int(time[-1])
+        self.count += len(time)
+
+    def merge(self, other):
+        """
+        Combine with an accumulator covering the samples directly following this one
+        """
+        if (self.threshold, self.noise_threshold) != (other.threshold, other.noise_threshold):
+            raise ValueError("Cannot merge ballast accumulators with different thresholds")
+        if other.start != self.start + self.count:
+            raise ValueError(f"Cannot merge ballast accumulators that are not contiguous: expected start "
+                             f"{self.start + self.count}, got {other.start}")
+        merged = BallastAccumulator(self.threshold, self.noise_threshold, self.start)
+        merged.count = self.count + other.count
+        merged.first_time = self.first_time if self.first_time is not None else other.first_time
+        merged.last_time = other.last_time if other.last_time is not None else self.last_time
+        merged.ballast = self.ballast.merge(other.ballast)
+        merged.depth = self.depth.merge(other.depth)
+        merged.dive_num = self.dive_num.merge(other.dive_num)
+        merged.pump = {step: pump.merge(other.pump[step]) for step, pump in self.pump.items()}
+        merged.crossover = self.crossover.merge(other.crossover)
+        merged.dive_range = self.dive_range.merge(other.dive_range)
+        return merged
+
+    def thin_step(self):
+        if self.count < 2:
+            return thin_step_slow
+        mean_interval = (self.last_time - self.first_time) / (self.count - 1) / 1e9
+        return thin_step_fast if mean_interval < fast_sampling_interval else thin_step_slow
+
+    def result(self):
+        """
+        Returns a dict of the ballast statistics, keyed by the column names of the ballast table
+        """
+        top_range, low_range = self.dive_range.ranges()
+        pump_range = top_range - low_range
+        return {'total dives': int(self.dive_num.max), 'max depth (m)': int(self.depth.max),
+                'max ballast (ml)': int(self.ballast.max), 'min ballast (ml)': int(self.ballast.min),
+                'avg max pumping value (ml)': int(np.nanmean(top_range)), 'std_max': int(np.nanstd(top_range)),
+                'std_min': int(np.nanstd(low_range)), 'avg min pumping value (ml)': int(np.nanmean(low_range)),
+                'avg pumping range (ml)': int(np.nanmean(pump_range)),
+                'total active pumping (ml)': int(self.pump[self.thin_step()].total),
+                'times crossing over ' + str(self.threshold) + ' ml': self.crossover.count,
+                'threshold': self.threshold}
+
+    def to_dict(self):
+        return {"threshold": self.threshold, "noise_threshold": self.noise_threshold, "start": self.start,
+                "count": self.count, "first_time": self.first_time, "last_time": self.last_time,
+                "ballast": self.ballast.to_dict(), "depth": self.depth.to_dict(),
+                "dive_num": self.dive_num.to_dict(),
+                "pump": [pump.to_dict() for pump in self.pump.values()],
+                "crossover": self.crossover.to_dict(), "dive_range": self.dive_range.to_dict()}
+
+    @classmethod
+    def from_dict(cls, state):
+        acc = cls(state["threshold"], state["noise_threshold"], state["start"])
+        acc.count = state["count"]
+        acc.first_time = state["first_time"]
+        acc.last_time = state["last_time"]
+        acc.ballast = ExtremaAccumulator.from_dict(state["ballast"])
+        acc.depth = ExtremaAccumulator.from_dict(state["depth"])
+        acc.dive_num = ExtremaAccumulator.from_dict(state["dive_num"])
+        acc.pump = {}
+        for pump_state in state["pump"]:
+            pump = PumpVolumeAccumulator.from_dict(pump_state)
+            acc.pump[pump.step] = pump
+        acc.crossover = CrossoverAccumulator.from_dict(state["crossover"])
+        acc.dive_range = DiveRangeAccumulator.from_dict(state["dive_range"])
+        return acc
@@ -0,0 +1,228 @@
+import argparse
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import ballast_info
+import metadata_tables
+import voto_erddap_utils as utils
+from request_planner import RequestPlanner
+
+_log = logging.getLogger(__name__)
+
+
+class MetadataService:
+    """
+    Resident version of the metadata_tables pipeline.
+    The dataset catalog, dataset metadata and downloaded nrt datasets are kept in memory between cycles. The
+    metadata tables and ballast table are rebuilt on their own intervals, and only datasets whose maxTime has
+    changed in the catalog since the last cycle are re-downloaded and reprocessed.
+    """
+
+    def __init__(self, meta_interval=3600, ballast_interval=21600, processes=None):
+        self.intervals = {"meta": meta_interval, "ballast": ballast_interval}
+        self.processes = processes
+        self.catalog = None
+        self.ds_meta = {}
+        self.ds_nrt = {}
+        # stage -> {datasetID: maxTime} as seen at the last successful run of that stage
+        self._seen = {"meta": {}, "ballast": {}}
+        self._next_run = {"meta": 0.0, "ballast": 0.0}
+        self._lock = threading.Lock()
+        self._status = {
+            "started": _utcnow(),
+            "catalog": {"last_fetch": None, "duration_s": None, "datasets": 0},
+            "meta": _empty_stage_status(),
+            "ballast": _empty_stage_status(),
+        }
+
+    def status(self):
+        with self._lock:
+            return json.loads(json.dumps(self._status, default=str))
+
+    def _set_status(self, key, **kwargs):
+        with self._lock:
+            self._status[key].update(kwargs)
+
+    def refresh_catalog(self):
+        start = time.monotonic()
+        self.catalog = metadata_tables.fetch_catalog()
+        self._set_status("catalog", last_fetch=_utcnow(), duration_s=round(time.monotonic() - start, 3),
+                         datasets=len(self.catalog))
+
+    def changed(self, stage, dataset_ids):
+        """
+        Return the datasets that are new to a stage, and those whose maxTime changed since the stage last ran
+        """
+        seen = self._seen[stage]
+        max_times = self.catalog["maxTime (UTC)"].astype(str)
+        new = [ds_id for ds_id in dataset_ids if ds_id not in seen]
+        updated = [ds_id for ds_id in dataset_ids if ds_id in seen and seen[ds_id] != max_times[ds_id]]
+        return new, updated
+
+    def _mark_seen(self, stage, dataset_ids):
+        max_times = self.catalog["maxTime (UTC)"].astype(str)
+        for ds_id in dataset_ids:
+            self._seen[stage][ds_id] = max_times[ds_id]
+
+    def _fresh_nrt(self):
+        """
+        Return the nrt datasets held in memory that are up to date with the catalog
+        """
+        max_times = self.catalog["maxTime (UTC)"].astype(str)
+        return {ds_id: ds for ds_id, ds in self.ds_nrt.items()
+                if ds_id in max_times.index and self._seen["meta"].get(ds_id) == max_times[ds_id]}
+
+    def run_meta(self):
+        df_datasets = metadata_tables.nrt_datasets(catalog=self.catalog)
+        new, updated = self.changed("meta", df_datasets.index)
+        removed = [ds_id for ds_id in self.ds_meta if ds_id not in df_datasets.index]
+        for ds_id in removed:
+            self.ds_meta.pop(ds_id, None)
+            self.ds_nrt.pop(ds_id, None)
+            self._seen["meta"].pop(ds_id, None)
+        to_process = new + updated
+        if not to_process and not removed:
+            _log.info("metadata tables up to date")
+            return 0
+        _log.info(f"updating metadata for {len(to_process)} datasets, removing {len(removed)}")
+        for ds_id in to_process:
+            self.ds_meta[ds_id] = utils.get_meta(ds_id)
+        downloaded = utils.download_glider_dataset(to_process, nrt_only=True)
+        self.ds_nrt.update(downloaded)
+        failed = [ds_id for ds_id in to_process if ds_id not in downloaded]
+        for ds_id in failed:
+            # Drop the stale copy of updated datasets. Datasets that are not marked as seen are retried next cycle
+            self.ds_nrt.pop(ds_id, None)
+        missing = [ds_id for ds_id in df_datasets.index if ds_id not in self.ds_nrt]
+        if missing:
+            _log.warning(f"skipping datasets that failed to download: {missing}")
+            df_datasets = df_datasets.drop(missing)
+        metadata_tables.build_tables(df_datasets, self.ds_meta, self.ds_nrt, processes=self.processes)
+        self._mark_seen("meta", downloaded.keys())
+        return len(downloaded)
+
+    def run_ballast(self):
+        n_processed = 0
+        for data_type in ("nrt", "delayed"):
+            missions = ballast_info.select_datasets(data_type=data_type, catalog=self.catalog)
+            _, updated = self.changed("ballast", missions)
+            to_process = metadata_tables.missing_ballast(missions)
+            to_process = [ds_id for ds_id in missions if ds_id in to_process or ds_id in updated]
+            processed = []
+            if to_process:
+                _log.info(f"updating ballast info for {len(to_process)} {data_type} datasets")
+                planner = None
+                if data_type == "nrt":
+                    # nrt datasets already downloaded by the meta stage for the current maxTime are not downloaded
+                    # again. Delayed datasets are not shared and are read from the disk cache one at a time
+                    planner = RequestPlanner(datasets=self._fresh_nrt())
+                    planner.declare(to_process, variables=ballast_info.ballast_variables)
+                processed = metadata_tables.proc_ballast(to_process, planner=planner, refresh=updated)
+            # Missions that failed to download are not marked as seen, so they are retried next cycle
+            self._mark_seen("ballast", [ds_id for ds_id in missions if ds_id not in to_process or ds_id in processed])
+            n_processed += len(processed)
+        return n_processed
+
+    def _run_stage(self, stage):
+        run = {"meta": self.run_meta, "ballast": self.run_ballast}[stage]
+        start = time.monotonic()
+        self._set_status(stage, running=True, last_start=_utcnow())
+        try:
+            n_processed = run()
+            self._set_status(stage, last_error=None, last_processed=n_processed, last_success=_utcnow())
+        except Exception as ex:
+            _log.exception(f"{stage} processing failed")
+            self._set_status(stage, last_error=repr(ex))
+        duration = round(time.monotonic() - start, 3)
+        self._next_run[stage] = time.monotonic() + self.intervals[stage]
+        next_run = datetime.now(timezone.utc) + timedelta(seconds=self.intervals[stage])
+        with self._lock:
+            self._status[stage]["runs"] += 1
+        self._set_status(stage, running=False, last_duration_s=duration,
+                         next_run=next_run.isoformat(timespec="seconds"))
+        _log.info(f"{stage} processing took {duration} s")
+
+    def run_forever(self):
+        while True:
+            now = time.monotonic()
+            due = [stage for stage, next_run in self._next_run.items() if next_run <= now]
+            if due:
+                try:
+                    self.refresh_catalog()
+                except Exception:
+                    _log.exception("catalog fetch failed")
+                    due = []
+                    for stage in self._next_run:
+                        self._next_run[stage] = max(self._next_run[stage], now + 60)
+            for stage in due:
+                self._run_stage(stage)
+            time.sleep(max(1.0, min(self._next_run.values()) - time.monotonic()))
+
+
+def _utcnow():
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+
+def _empty_stage_status():
+    return {"running": False, "runs": 0, "last_start": None, "last_success": None, "last_duration_s": None,
+            "last_processed": None, "last_error": None, "next_run": None}
+
+
+def serve_status(service, host="127.0.0.1", port=8787):
+    """
+    Serve the service status as JSON on http://host:port/status from a background thread
+    """
+
+    class StatusHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip("/") not in ("", "/status"):
+                self.send_error(404)
+                return
+            body = json.dumps(service.status(), indent=2).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            _log.debug(format % args)
+
+    server = ThreadingHTTPServer((host, port), StatusHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    _log.info(f"status endpoint listening on http://{host}:{port}/status")
+    return server
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Run the metadata pipeline as a resident service")
+    parser.add_argument("--meta-interval", type=float, default=3600,
+                        help="seconds between metadata table updates")
+    parser.add_argument("--ballast-interval", type=float, default=21600,
+                        help="seconds between ballast table updates")
+    parser.add_argument("--processes", type=int,
+                        help="number of worker processes used to flatten metadata and attributes. Gives almost no "
+                             "speedup as the attributes are parsed in the main process")
+    parser.add_argument("--host", default="127.0.0.1", help="address of the status endpoint")
+    parser.add_argument("--port", type=int, default=8787, help="port of the status endpoint")
+    parser.add_argument("--log-file", default='/home/pipeline/log/metadata_service.log')
+    args = parser.parse_args(args)
+    logging.basicConfig(filename=args.log_file,
+                        filemode='a',
+                        format='%(asctime)s %(levelname)-8s %(message)s',
+                        level=logging.INFO,
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    service = MetadataService(meta_interval=args.meta_interval, ballast_interval=args.ballast_interval,
+                              processes=args.processes)
+    serve_status(service, host=args.host, port=args.port)
+    _log.info("Start metadata service")
+    service.run_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,10 @@
-from tqdm import tqdm
 import pandas as pd
-import numpy as np
 from pathlib import Path
+import attribute_tables
 import ballast_info
 import subprocess
 import voto_erddap_utils as utils
+from request_planner import RequestPlanner
 import logging
 import os
 cwdir = os.getcwd()
@@ -22,7 +22,10 @@ def write_csv(df, name):
     _log.info(f"sent '{cwdir}/output/{name}.csv to erddap")
 
 
-def meta_proc():
+def fetch_catalog():
+    """
+    Fetch the table of all datasets on the VOTO ERDDAP server, indexed by datasetID
+    """
     e = utils.init_erddap()
 
     # Fetch dataset list
@@ -33,10 +36,33 @@ def meta_proc():
     # drop the allDatasets row and make the datasetID the index for easier reading
     df_datasets.set_index("datasetID", inplace=True)
     df_datasets.drop("allDatasets", inplace=True)
+    return df_datasets
 
-    df_datasets = df_datasets[df_datasets.index.str[:3] == "nrt"]
+
+def nrt_datasets(catalog=None):
+    """
+    Return the table of nrt datasets to be included in the metadata tables
+    catalog: table of all datasets, as returned by fetch_catalog. Fetched if not supplied
+    """
+    if catalog is None:
+        catalog = fetch_catalog()
+    df_datasets = catalog[catalog.index.str[:3] == "nrt"]
     df_datasets = df_datasets.drop('nrt_SEA057_M75')
     df_datasets = df_datasets.drop('nrt_SEA070_M29')
+    return df_datasets
+
+
+def meta_proc(df_datasets=None, planner=None, processes=None):
+    """
+    Build the metadata tables and send them to the ERDDAP server
+    df_datasets: table of datasets to process, as returned by nrt_datasets. Fetched if not supplied
+    planner: optional RequestPlanner the datasets have been declared to. If not supplied, datasets are downloaded
+    processes: number of worker processes used to flatten the metadata and attributes. If None, no pool is used.
+    Gives almost no speedup as the attributes are parsed in this process
+    """
+    from tqdm import tqdm
+    if df_datasets is None:
+        df_datasets = nrt_datasets()
 
     # df_datasets = df_datasets.head(3)
     _log.info(f"found {len(df_datasets)} datasets")
@@ -46,63 +72,32 @@ def meta_proc():
         ds_meta[dataset_id] = utils.get_meta(dataset_id)
 
     # Download data
-    ds_nrt = utils.download_glider_dataset(df_datasets.index, nrt_only=True)
-
+    if planner is None:
+        ds_nrt = utils.download_glider_dataset(df_datasets.index, nrt_only=True)
+    else:
+        ds_nrt = planner.views(df_datasets.index)
+    build_tables(df_datasets, ds_meta, ds_nrt, processes=processes)
+
+
+def build_tables(df_datasets, ds_meta, ds_nrt, processes=None):
+    """
+    Build the metadata, attributes and users tables and send them to the ERDDAP server
+    df_datasets: table of datasets to process
+    ds_meta: dict of dataset metadata, as returned by get_meta, keyed by datasetID
+    ds_nrt: dict of downloaded datasets keyed by datasetID
+    processes: number of worker processes used to flatten the metadata and attributes. If None, no pool is used.
+    Gives almost no speedup as the attributes are parsed in this process
+    """
     # Merge all metadata available in one big column
-
-    df_met = []
     _log.info(f"processing metadata files")
-    for dataset_id in df_datasets.index:
-        dictrow = {}
-        for key, val in ds_meta[dataset_id].items():
-            # If the value is a method (like dataset.close) do not include it
-            if callable(val):
-                continue
-            if type(val) is dict:
-                if val == {}:
-                    continue
-                for k, v in val.items():
-                    if type(v) is dict:
-                        for c, u in v.items():
-                            dictrow[f'{k}_{c}'] = u
-                    else:
-                        dictrow[f'{key}_{k}'] = v
-            elif type(val) is str:
-                val_rep = val.replace("\n", "")
-                dictrow[key] = val_rep
-            elif type(val) is list:
-                dictrow[key] = str(val)
-            else:
-                dictrow[key] = val
-
-        dfrow = pd.DataFrame(dictrow, index=[dataset_id])
-        df_met.append(dfrow)
-
-    df_met_all = pd.concat(df_met)
+    df_met_all = attribute_tables.metadata_table({dataset_id: ds_meta[dataset_id] for dataset_id in df_datasets.index},
+                                                 processes=processes)
     write_csv(df_met_all, 'metadata_table')
 
     # Merge all variables attributes into one table
-
-    dat_var = []
     _log.info(f"processing attributes files")
-    for dataset_id in df_datasets.index[:]:
-
-        d_row = {}
-        vars_data = list(ds_nrt[dataset_id].data_vars)
-        for i in vars_data[:]:
-            att = ds_nrt[dataset_id][i].attrs
-            for key, val in att.items():
-                if type(val) is list or np.array:
-                    d_row[f'{i}_{key}'] = str(val)
-                elif str("\n") in str(val):
-                    d_row[key] = str(val).replace("\n", "")
-                else:
-                    d_row[f'{i}_{key}'] = val
-
-        df_row = pd.DataFrame(d_row, index=[dataset_id])
-        dat_var.append(df_row)
-
-    var_all = pd.concat(dat_var)
+    var_all = attribute_tables.var_attrs_table({dataset_id: ds_nrt[dataset_id] for dataset_id in df_datasets.index},
+                                               processes=processes)
     write_csv(var_all, 'var_attrs_table')
     # Merge the metadata table with the attributes table
 
@@ -139,39 +134,63 @@ def meta_proc():
         if 'nitrate' in d:
             table.nitrate[i] = d['nitrate']
 
-        nav_var = {'profile_index', 'rowSize', 'latitude', 'longitude', 'time', 'depth',
-                   'angular_cmd', 'angular_pos', 'ballast_cmd', 'ballast_pos', 'desired_heading',
-                   'dive_num', 'heading', 'internal_pressure', 'internal_temperature', 'linear_cmd',
-                   'linear_pos', 'nav_state', 'pitch', 'profile_direction', 'profile_num',
-                   'roll', 'security_level', 'vertical_distance_to_seafloor', 'voltage', 'declination'}
-
         # Iterate each element in list
         # and add them in variable total
-        table.science_variables[i] = [i for i in table.science_variables[i] if i not in nav_var]
+        table.science_variables[i] = [i for i in table.science_variables[i] if i not in utils.nav_variables]
 
     write_csv(table, 'users_table')
 
 
-def proc_ballast(missions):
+def missing_ballast(missions):
+    """
+    Return the missions that do not yet have a row in the ballast table
+    """
     outfile = Path("output/ballast.csv")
+    if not outfile.exists():
+        return list(missions)
+    df = pd.read_csv(outfile, sep=';')
+    return [ds_id for ds_id in missions if ds_id not in df['datasetID'].values]
+
+
+def proc_ballast(missions, planner=None, refresh=()):
+    """
+    Add ballast info for missions that are not yet in the ballast table
+    planner: optional RequestPlanner the missions have been declared to
+    refresh: missions whose existing ballast rows are recomputed, e.g. missions that received new data
+    Returns the missions whose rows were added or recomputed. Missions that failed to download keep their old row
+    """
+    outfile = Path("output/ballast.csv")
+    processed = []
     for ds_id in missions:
         to_download = [ds_id]
         if outfile.exists():
             df = pd.read_csv(outfile, sep=';')
+            if ds_id in refresh:
+                df = df[df['datasetID'] != ds_id]
             to_download = set(to_download).difference(df['datasetID'].values)
         else:
             df = pd.DataFrame()
         if len(to_download) == 0:
             _log.debug("No datasets found matching supplied arguments")
         else:
-            df_add = ballast_info.ballast_info(to_download)
+            if ds_id in refresh and ds_id.startswith('nrt'):
+                # nrt data is appended to, so only the samples added since the row was last computed are processed
+                df_add = ballast_info.update_ballast_info(ds_id, planner=planner)
+            else:
+                # Delayed datasets are reprocessed as a whole, the saved statistics are overwritten
+                df_add = ballast_info.ballast_info(to_download, planner=planner)
+            if df_add.empty:
+                _log.warning(f"failed to download dataset {ds_id} for ballast info")
+                continue
             df = pd.concat((df, df_add))
             df = df.groupby('datasetID').first()
             write_csv(df, 'ballast')
             _log.debug(f"Added ballast info for dataset {ds_id}")
+            processed.append(ds_id)
     df = pd.read_csv(outfile, sep=';')
     _log.info(f"ballast data present for {len(df[df.datasetID.str.contains('nrt')])} nrt datasets")
     _log.info(f"ballast data present for {len(df[df.datasetID.str.contains('delayed')])} delayed datasets")
+    return processed
 
 
 if __name__ == '__main__':
@@ -182,10 +201,18 @@ if __name__ == '__main__':
                         level=logging.INFO,
                         datefmt='%Y-%m-%d %H:%M:%S')
     _log.info("Start processing")
-    meta_proc()
-    all_nrt = ballast_info.select_datasets(mission_num=None, glider_serial=None, data_type='nrt')
-    all_delayed = ballast_info.select_datasets(mission_num=None, glider_serial=None, data_type='delayed')
-    proc_ballast(all_nrt)
+    # Fetch the dataset list once for all stages
+    catalog = fetch_catalog()
+    df_nrt = nrt_datasets(catalog=catalog)
+    all_nrt = ballast_info.select_datasets(mission_num=None, glider_serial=None, data_type='nrt', catalog=catalog)
+    all_delayed = ballast_info.select_datasets(mission_num=None, glider_serial=None, data_type='delayed',
+                                               catalog=catalog)
+    # Declare every stage's needs up front so each dataset is only downloaded once
+    planner = RequestPlanner()
+    planner.declare(df_nrt.index)
+    planner.declare(missing_ballast(all_nrt), variables=ballast_info.ballast_variables)
+    meta_proc(df_nrt, planner=planner)
+    proc_ballast(all_nrt, planner=planner)
+    # delayed datasets are not shared with other stages and are read from the disk cache one at a time
     proc_ballast(all_delayed)
     _log.info("End processing")
-
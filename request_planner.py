@@ -0,0 +1,88 @@
+import voto_erddap_utils as utils
+
+
+class RequestPlanner:
+    """
+    Run-scoped planner for ERDDAP downloads.
+    Pipeline stages declare the datasets and variables they need up front. On first use, the planner merges
+    the declarations so that each dataset is downloaded exactly once, then hands out views containing only the
+    variables each stage asked for.
+    """
+
+    def __init__(self, datasets=None):
+        """
+        datasets: optional dict of datasets already downloaded with all variables, keyed by datasetID. Declared
+        datasets found here are not downloaded again
+        """
+        # dataset_id -> ordered dict of variables (None means all variables)
+        self._variables = {}
+        self._adcp = {}
+        self._prefetched = dict(datasets or {})
+        self._datasets = None
+
+    def declare(self, dataset_ids, variables=(), adcp=False):
+        """
+        Register datasets needed by a stage.
+        dataset_ids: list of datasetIDs present on the VOTO ERDDAP
+        variables: data variables needed. If left empty, all variables are needed
+        adcp: if True, ADCP data is merged into the dataset
+        """
+        if self._datasets is not None:
+            raise RuntimeError("Cannot declare datasets after the planner has fetched data")
+        for ds_id in dataset_ids:
+            if not variables:
+                self._variables[ds_id] = None
+            elif ds_id not in self._variables:
+                self._variables[ds_id] = dict.fromkeys(variables)
+            elif self._variables[ds_id] is not None:
+                self._variables[ds_id].update(dict.fromkeys(variables))
+            self._adcp[ds_id] = self._adcp.get(ds_id, False) or adcp
+
+    def requests(self):
+        """
+        Merge declarations into the minimum set of download requests.
+        Returns a list of (dataset_ids, variables, adcp) tuples, one per distinct request
+        """
+        grouped = {}
+        for ds_id, variables in self._variables.items():
+            if ds_id in self._prefetched:
+                continue
+            variables = () if variables is None else tuple(variables)
+            key = (variables, self._adcp[ds_id])
+            grouped.setdefault(key, []).append(ds_id)
+        return [(ds_ids, variables, adcp) for (variables, adcp), ds_ids in grouped.items()]
+
+    def fetch(self):
+        """
+        Download every declared dataset once. Called automatically on first access
+        """
+        if self._datasets is not None:
+            return self._datasets
+        self._datasets = {ds_id: ds for ds_id, ds in self._prefetched.items() if ds_id in self._variables}
+        for ds_ids, variables, adcp in self.requests():
+            self._datasets.update(utils.download_glider_dataset(ds_ids, variables=variables, adcp=adcp))
+        return self._datasets
+
+    def view(self, dataset_id, variables=()):
+        """
+        Return the dataset restricted to the requested data variables. Coordinates and attributes are kept.
+        Raises KeyError if the dataset was not declared or failed to download
+        """
+        if dataset_id not in self._variables:
+            raise KeyError(f"{dataset_id} was not declared to the request planner")
+        ds = self.fetch()[dataset_id]
+        if not variables:
+            return ds
+        drop = [var_name for var_name in ds.data_vars if var_name not in variables]
+        return ds.drop_vars(drop)
+
+    def views(self, dataset_ids, variables=()):
+        """
+        Return a dict of views for the supplied dataset IDs. Datasets that failed to download are skipped,
+        matching the behaviour of download_glider_dataset
+        """
+        undeclared = [ds_id for ds_id in dataset_ids if ds_id not in self._variables]
+        if undeclared:
+            raise KeyError(f"{undeclared} were not declared to the request planner")
+        datasets = self.fetch()
+        return {ds_id: self.view(ds_id, variables) for ds_id in dataset_ids if ds_id in datasets}
@@ -0,0 +1,18 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# The modules live at the repository root rather than in a package
+sys.path.insert(0, str(Path(__file__).parents[1]))
+
+import voto_erddap_utils as utils  # noqa: E402
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    """
+    Redirect the dataset cache to a temporary directory
+    """
+    monkeypatch.setattr(utils, "cache_dir", tmp_path)
+    return tmp_path
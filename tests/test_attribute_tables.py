@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+import attribute_tables
+
+
+def _concat_table(rows, index):
+    # The table building that metadata_tables did before attribute_tables was introduced
+    return pd.concat([pd.DataFrame(row, index=[ds_id]) for ds_id, row in zip(index, rows)])
+
+
+def _metas():
+    return {
+        "nrt_SEA001_M1": {"glider_serial": 1, "deployment_id": 10, "basin": "Bornholm Basin", "calibrated": True,
+                          "lat_max": 55.1, "ctd": {"make": "RBR", "serial": "66"}, "variables": ["time", "depth"],
+                          "summary": "first\nsecond", "close": print},
+        "nrt_SEA002_M1": {"glider_serial": 2, "deployment_id": 11, "basin": "", "calibrated": False,
+                          "lat_max": 57, "ctd": {"make": "SBE", "calibration": {"date": "2023-01-01"}},
+                          "variables": ["time"], "summary": "", "close": print},
+        "nrt_SEA003_M1": {"glider_serial": 3, "basin": "Skagerrak", "lat_max": 58.4, "oxygen": {},
+                          "summary": "third", "close": print},
+    }
+
+
+def test_parse_attribute_evaluates_literals():
+    assert attribute_tables.parse_attribute("{'make': 'RBR', 'serial': '66'}") == {"make": "RBR", "serial": "66"}
+    assert attribute_tables.parse_attribute("{__import__('os')}") == "{__import__('os')}"
+    assert attribute_tables.parse_attribute("{'make': 'RBR'") == "{'make': 'RBR'"
+
+
+def test_parse_attribute_does_not_share_memoised_values():
+    parsed = attribute_tables.parse_attribute("{'ctd': {'make': 'RBR'}}")
+    parsed["ctd"]["make"] = "SBE"
+    parsed["oxygen"] = {}
+    assert attribute_tables.parse_attribute("{'ctd': {'make': 'RBR'}}") == {"ctd": {"make": "RBR"}}
+
+
+@pytest.mark.parametrize("processes", [None, 2])
+def test_metadata_table_matches_concat(processes):
+    ds_meta = _metas()
+    rows = [attribute_tables.flatten_meta(meta) for meta in ds_meta.values()]
+    expected = _concat_table(rows, ds_meta.keys())
+    table = attribute_tables.metadata_table(ds_meta, processes=processes)
+    pd.testing.assert_frame_equal(table, expected)
+    assert table["deployment_id"].dtype == float
+    assert table["calibrated"].dtype == object
+    assert table["glider_serial"].dtype == np.int64
+    assert np.isnan(table.loc["nrt_SEA001_M1", "calibration_date"])
+
+
+@pytest.mark.parametrize("processes", [None, 2])
+def test_var_attrs_table_matches_concat(processes):
+    datasets = {
+        "nrt_SEA001_M1": xr.Dataset({"temperature": ("time", [1.0], {"units": "Celsius", "valid_min": -5}),
+                                     "salinity": ("time", [35.0], {"units": "PSU"})}),
+        "nrt_SEA002_M1": xr.Dataset({"temperature": ("time", [2.0], {"units": "Celsius",
+                                                                    "flag_values": np.array([1, 2])})}),
+    }
+    rows = [{f"{var_name}_{key}": str(val) for var_name in ds.data_vars for key, val in ds[var_name].attrs.items()}
+            for ds in datasets.values()]
+    expected = _concat_table(rows, datasets.keys())
+    pd.testing.assert_frame_equal(attribute_tables.var_attrs_table(datasets, processes=processes), expected)
@@ -0,0 +1,151 @@
+import json
+
+import numpy as np
+import pytest
+import xarray as xr
+
+import ballast_info
+import ballast_stats
+import voto_erddap_utils as utils
+from request_planner import RequestPlanner
+
+
+def _mission(sampling_interval, n, seed=0):
+    rng = np.random.default_rng(seed)
+    time = np.datetime64("2024-01-01") + (np.arange(n) * sampling_interval * 1e9).astype("timedelta64[ns]")
+    # 97 samples per dive, so dives straddle any chunk size used below
+    dive_num = np.repeat(np.arange(1, n // 97 + 2), 97)[:n].astype(float)
+    pos = np.round(400 + 60 * np.sin(np.arange(n) / 13.0) + rng.normal(0, 4, n), 1)
+    cmd = pos + rng.normal(0, 1, n)
+    pos[rng.random(n) < 0.05] = np.nan
+    cmd[rng.random(n) < 0.05] = np.nan
+    return xr.Dataset({"ballast_pos": ("time", pos), "ballast_cmd": ("time", cmd), "dive_num": ("time", dive_num),
+                       "nav_state": ("time", np.where(rng.random(n) < 0.3, 117, 110)),
+                       "security_level": ("time", np.where(rng.random(n) < 0.002, 1, 0)),
+                       "depth": ("time", -np.abs(100 * np.sin(np.arange(n) / 50.0)))},
+                      coords={"time": time},
+                      attrs={"deployment_id": 5, "glider_serial": 63, "basin": "Bornholm Basin"})
+
+
+def _whole_mission(ds, threshold=420, noise_threshold=5):
+    # The whole-mission computation that ballast_info did before the accumulators were introduced
+    result = {"max ballast (ml)": int(np.nanmax(ds.ballast_pos)), "min ballast (ml)": int(np.nanmin(ds.ballast_pos)),
+              "total dives": int(ds.dive_num.values.max()), "max depth (m)": int(np.nanmax(np.abs(ds.depth)))}
+    if np.diff(ds.time).mean() / np.timedelta64(1, "s") < 0.8:
+        thinned = ds.thin({"time": 70})
+    else:
+        thinned = ds.thin({"time": 15})
+    thinned = thinned.isel(time=np.isfinite(thinned.ballast_pos.values))
+    thinned = thinned.isel(time=np.isfinite(thinned.ballast_cmd.values))
+    pos_diff = np.diff(thinned.ballast_pos.values)
+    result["total active pumping (ml)"] = int(np.sum(np.where(pos_diff > noise_threshold, pos_diff, 0)))
+    ballast = ds.ballast_pos.values
+    ballast = ballast[~np.isnan(ballast)]
+    ballast_pre = ballast.copy()[:-1]
+    ballast_post = ballast.copy()[1:]
+    ballast_pre[ballast_pre > threshold] = np.nan
+    ballast_post[ballast_post < threshold] = np.nan
+    result[f"times crossing over {threshold} ml"] = int(sum(ballast_post - ballast_pre > 0))
+    top_range, low_range = [], []
+    for dive in np.unique(ds.dive_num.values):
+        ds_dive = ds.isel(time=ds.dive_num.values == dive)
+        going_up = ds_dive.isel(time=ds_dive.nav_state.values == 117)
+        if (ds_dive.security_level.values > 0).any():
+            top_range.append(np.nan)
+            low_range.append(np.nan)
+        elif going_up.sizes["time"]:
+            top_range.append(int(np.nanmax(going_up.ballast_pos.values)))
+            low_range.append(int(np.nanmin(ds_dive.ballast_pos.values)))
+        else:
+            top_range.append(np.nan)
+            low_range.append(int(np.nanmin(ds_dive.ballast_pos.values)))
+    pump_range = np.array(top_range) - np.array(low_range)
+    result.update({"avg max pumping value (ml)": int(np.nanmean(top_range)),
+                   "avg min pumping value (ml)": int(np.nanmean(low_range)),
+                   "avg pumping range (ml)": int(np.nanmean(pump_range)),
+                   "std_max": int(np.nanstd(top_range)), "std_min": int(np.nanstd(low_range))})
+    return result
+
+
+def _assert_matches(acc, expected):
+    result = acc.result()
+    assert {key: result[key] for key in expected} == expected
+
+
+@pytest.mark.parametrize("sampling_interval, thin_step", [(0.5, 70), (2.0, 15)])
+@pytest.mark.parametrize("chunk_size", [64, 997, 100000])
+def test_chunked_matches_whole_mission(sampling_interval, thin_step, chunk_size):
+    ds = _mission(sampling_interval, 5003)
+    acc = ballast_info.accumulate_ballast(ds, chunk_size=chunk_size)
+    assert acc.thin_step() == thin_step
+    _assert_matches(acc, _whole_mission(ds))
+
+
+@pytest.mark.parametrize("sampling_interval", [0.5, 2.0])
+def test_merged_matches_whole_mission(sampling_interval):
+    ds = _mission(sampling_interval, 5003)
+    # Split inside a dive and off the thinning grid
+    split = 1234
+    first = ballast_info.accumulate_ballast(ds.isel(time=slice(0, split)), chunk_size=500)
+    first = ballast_stats.BallastAccumulator.from_dict(json.loads(json.dumps(first.to_dict())))
+    second = ballast_info.accumulate_ballast(ds.isel(time=slice(split, None)), chunk_size=333,
+                                             start=first.start + first.count)
+    _assert_matches(first.merge(second), _whole_mission(ds))
+
+
+def test_merge_requires_contiguous_accumulators():
+    ds = _mission(2.0, 500)
+    first = ballast_info.accumulate_ballast(ds.isel(time=slice(0, 200)))
+    second = ballast_info.accumulate_ballast(ds.isel(time=slice(200, None)))
+    with pytest.raises(ValueError):
+        first.merge(second)
+
+
+def _serve(monkeypatch, datasets):
+    def download_glider_dataset(dataset_ids, **kwargs):
+        return {ds_id: datasets[ds_id] for ds_id in dataset_ids if ds_id in datasets}
+    monkeypatch.setattr(utils, "download_glider_dataset", download_glider_dataset)
+
+
+def _update(dataset_id):
+    planner = RequestPlanner()
+    planner.declare([dataset_id], variables=ballast_info.ballast_variables)
+    return ballast_info.update_ballast_info(dataset_id, planner=planner)
+
+
+def test_update_nrt_processes_appended_samples(cache_dir, monkeypatch):
+    ds = _mission(2.0, 3000)
+    _serve(monkeypatch, {"nrt_SEA063_M5": ds.isel(time=slice(0, 2000))})
+    ballast_info.ballast_info(["nrt_SEA063_M5"])
+    _serve(monkeypatch, {"nrt_SEA063_M5": ds})
+    row = _update("nrt_SEA063_M5").iloc[0]
+    for key, val in _whole_mission(ds).items():
+        assert row[key] == val
+
+
+@pytest.mark.parametrize("dataset_id, change", [("delayed_SEA063_M5", "reprocessed"),
+                                                ("nrt_SEA063_M5", "reprocessed"), ("nrt_SEA063_M5", "backfilled")])
+def test_update_recomputes_reprocessed_missions(cache_dir, monkeypatch, dataset_id, change):
+    ds = _mission(2.0, 3000)
+    if change == "reprocessed":
+        # The values change throughout and the first samples are removed
+        processed = ds.isel(time=slice(0, 2000))
+        updated = ds.isel(time=slice(100, None))
+        updated["ballast_pos"] = updated.ballast_pos + 7
+    else:
+        # Samples in the middle of the mission arrive after it was first processed
+        processed = ds.isel(time=np.r_[0:800, 1000:2000])
+        updated = ds
+    _serve(monkeypatch, {dataset_id: processed})
+    ballast_info.ballast_info([dataset_id])
+    _serve(monkeypatch, {dataset_id: updated})
+    row = _update(dataset_id).iloc[0]
+    for key, val in _whole_mission(updated).items():
+        assert row[key] == val
+
+
+def test_update_reports_failed_download(cache_dir, monkeypatch):
+    _serve(monkeypatch, {"nrt_SEA063_M5": _mission(2.0, 2000)})
+    ballast_info.ballast_info(["nrt_SEA063_M5"])
+    _serve(monkeypatch, {})
+    assert _update("nrt_SEA063_M5").empty
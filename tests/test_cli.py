@@ -0,0 +1,22 @@
+import logging
+
+import pytest
+
+import metadata_service
+import voto_cli
+
+
+def test_serve_passes_options_to_service(monkeypatch, tmp_path):
+    services = []
+    monkeypatch.setattr(logging, "basicConfig", lambda **kwargs: None)
+    monkeypatch.setattr(metadata_service, "serve_status", lambda service, host, port: services.append((host, port)))
+    monkeypatch.setattr(metadata_service.MetadataService, "run_forever", lambda self: services.append(self))
+    voto_cli.main(["serve", "--meta-interval", "60", "--port", "9000", "--log-file", str(tmp_path / "service.log")])
+    address, service = services
+    assert address == ("127.0.0.1", 9000)
+    assert service.intervals == {"meta": 60, "ballast": 21600}
+
+
+def test_unknown_options_are_rejected_outside_serve():
+    with pytest.raises(SystemExit):
+        voto_cli.main(["cache", "--meta-interval", "60"])
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import voto_erddap_utils as utils
+
+
+def _profile_dataset(n=4000, date_created="2024-02-01"):
+    rng = np.random.default_rng(1)
+    time = np.datetime64("2024-01-01") + (np.arange(n) * 1e9).astype("timedelta64[ns]")
+    profile_num = np.repeat(np.arange(1, n // 200 + 1), 200).astype(float)
+    depth = np.abs(60 * np.sin(np.arange(n) / 64.0)) + rng.normal(0, 0.3, n)
+    temperature = 10 - depth / 10 + rng.normal(0, 0.1, n)
+    temperature[rng.random(n) < 0.1] = np.nan
+    profile_mean_time = pd.Series(time).groupby(profile_num).transform("mean").values
+    return xr.Dataset({"temperature": ("time", temperature, {"units": "Celsius"}),
+                       "depth": ("time", depth),
+                       "profile_num": ("time", profile_num),
+                       "profile_mean_time": ("time", profile_mean_time),
+                       "nav_state": ("time", np.zeros(n))},
+                      coords={"time": time},
+                      attrs={"dataset_id": "delayed_SEA001_M1", "date_created": date_created})
+
+
+def test_grid_matches_groupby(cache_dir):
+    ds = _profile_dataset()
+    edges = np.arange(0, 65, 5.0)
+    gridded = utils.grid_glider_dataset(ds, bin_edges=edges, reducers=("mean", "median", "count"))
+    assert "nav_state" not in gridded
+    df = pd.DataFrame({"profile": ds.profile_num.values, "bin": np.digitize(ds.depth.values, edges) - 1,
+                       "temperature": ds.temperature.values})
+    df = df[(df["bin"] >= 0) & (df["bin"] < len(edges) - 1)]
+    grouped = df.groupby(["profile", "bin"])["temperature"]
+    for reducer, name in (("mean", "temperature"), ("median", "temperature_median"), ("count", "temperature_count")):
+        expected = getattr(grouped, reducer)().unstack()
+        expected = expected.reindex(index=gridded.profile_num.values, columns=range(len(edges) - 1)).values
+        if reducer == "count":
+            expected = np.nan_to_num(expected)
+        np.testing.assert_allclose(gridded[name].values, expected, equal_nan=True)
+
+
+def test_regrid_same_process(cache_dir):
+    ds = _profile_dataset()
+    edges = np.arange(0, 65, 5.0)
+    first = utils.grid_glider_dataset(ds, bin_edges=edges)
+    cached = utils.grid_glider_dataset(ds, bin_edges=edges)
+    xr.testing.assert_identical(first, cached)
+    # A different configuration must not overwrite the file returned by the cache hit
+    default = utils.grid_glider_dataset(ds)
+    assert default.sizes["depth"] != first.sizes["depth"]
+    assert len(list(cache_dir.glob("delayed_SEA001_M1_gridded_*.nc"))) == 2
+    xr.testing.assert_identical(utils.grid_glider_dataset(ds, bin_edges=edges), first)
+    xr.testing.assert_identical(utils.grid_glider_dataset(ds), default)
+
+
+def test_regrid_after_raw_dataset_update(cache_dir):
+    edges = np.arange(0, 65, 5.0)
+    utils.grid_glider_dataset(_profile_dataset(), bin_edges=edges)
+    updated = _profile_dataset(date_created="2024-03-01")
+    gridded = utils.grid_glider_dataset(updated, bin_edges=edges)
+    assert gridded.attrs["date_created"] == "2024-03-01"
@@ -0,0 +1,30 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+heavy_modules = ("pandas", "xarray", "erddapy", "matplotlib", "requests")
+
+
+def _loaded_heavy_modules(module):
+    # A fresh interpreter, so that modules imported by other tests do not hide the imports
+    code = (f"import sys, json; import {module}; "
+            f"print(json.dumps([name for name in {heavy_modules!r} if name in sys.modules]))")
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                            cwd=Path(__file__).parents[1])
+    return set(json.loads(result.stdout))
+
+
+@pytest.mark.parametrize("module, allowed", [
+    ("voto_cli", set()),
+    ("voto_erddap_utils", set()),
+    ("attribute_tables", set()),
+    ("request_planner", set()),
+    # The table jobs use pandas throughout
+    ("ballast_info", {"pandas"}),
+    ("metadata_tables", {"pandas"}),
+])
+def test_heavy_modules_are_imported_lazily(module, allowed):
+    assert _loaded_heavy_modules(module) <= allowed
@@ -0,0 +1,77 @@
+import pandas as pd
+import xarray as xr
+
+import ballast_info
+import metadata_service
+import metadata_tables
+import voto_erddap_utils as utils
+
+
+def _catalog(max_times):
+    return pd.DataFrame({"maxTime (UTC)": pd.to_datetime(list(max_times.values()))},
+                        index=pd.Index(list(max_times), name="datasetID"))
+
+
+def _service(monkeypatch):
+    downloads = []
+    tables = []
+
+    def download_glider_dataset(dataset_ids, **kwargs):
+        downloads.append(list(dataset_ids))
+        return {ds_id: xr.Dataset(attrs={"version": len(downloads)}) for ds_id in dataset_ids}
+
+    monkeypatch.setattr(utils, "download_glider_dataset", download_glider_dataset)
+    monkeypatch.setattr(utils, "get_meta", lambda ds_id: {"dataset_id": ds_id})
+    monkeypatch.setattr(metadata_tables, "nrt_datasets", lambda catalog: catalog)
+    monkeypatch.setattr(metadata_tables, "build_tables",
+                        lambda df_datasets, ds_meta, ds_nrt, processes=None: tables.append(
+                            {ds_id: ds_nrt[ds_id].attrs["version"] for ds_id in df_datasets.index}))
+    return metadata_service.MetadataService(), downloads, tables
+
+
+def test_failed_update_is_dropped_and_retried(monkeypatch):
+    service, downloads, tables = _service(monkeypatch)
+    service.catalog = _catalog({"nrt_SEA001_M1": "2024-01-01", "nrt_SEA002_M1": "2024-01-01"})
+    service.run_meta()
+    service.catalog = _catalog({"nrt_SEA001_M1": "2024-01-02", "nrt_SEA002_M1": "2024-01-01"})
+    monkeypatch.setattr(utils, "download_glider_dataset", lambda dataset_ids, **kwargs: {})
+    service.run_meta()
+    # The stale copy is not published and the dataset is retried on the next cycle
+    assert tables[-1] == {"nrt_SEA002_M1": 1}
+    assert service.changed("meta", ["nrt_SEA001_M1"]) == ([], ["nrt_SEA001_M1"])
+
+
+def test_ballast_reuses_datasets_held_by_meta_stage(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    service, downloads, tables = _service(monkeypatch)
+    service.catalog = _catalog({"nrt_SEA001_M1": "2024-01-01", "nrt_SEA002_M1": "2024-01-01"})
+    service.run_meta()
+    received = {}
+
+    def proc_ballast(missions, planner=None, refresh=()):
+        if planner is not None:
+            received.update(planner.views(missions, variables=ballast_info.ballast_variables))
+        return list(missions)
+
+    monkeypatch.setattr(ballast_info, "select_datasets",
+                        lambda data_type, catalog: [ds_id for ds_id in catalog.index if data_type in ds_id])
+    monkeypatch.setattr(metadata_tables, "proc_ballast", proc_ballast)
+    service.run_ballast()
+    assert downloads == [["nrt_SEA001_M1", "nrt_SEA002_M1"]]
+    assert set(received) == {"nrt_SEA001_M1", "nrt_SEA002_M1"}
+
+
+def test_failed_ballast_update_is_retried(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    service, downloads, tables = _service(monkeypatch)
+    succeeded = []
+    monkeypatch.setattr(ballast_info, "select_datasets",
+                        lambda data_type, catalog: [ds_id for ds_id in catalog.index if data_type in ds_id])
+    monkeypatch.setattr(metadata_tables, "proc_ballast", lambda missions, planner=None, refresh=(): succeeded)
+    service.catalog = _catalog({"nrt_SEA001_M1": "2024-01-01"})
+    succeeded.append("nrt_SEA001_M1")
+    service.run_ballast()
+    service.catalog = _catalog({"nrt_SEA001_M1": "2024-01-02"})
+    succeeded.clear()
+    service.run_ballast()
+    assert service.changed("ballast", ["nrt_SEA001_M1"]) == ([], ["nrt_SEA001_M1"])
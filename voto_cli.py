@@ -0,0 +1,148 @@
+"""
+Command-line entry point for the VOTO metadata tools.
+
+    python voto_cli.py datasets [--data-type delayed]
+    python voto_cli.py download nrt_SEA063_M48 [--variables temperature salinity] [--adcp]
+    python voto_cli.py cache
+    python voto_cli.py tables [--processes 4]
+    python voto_cli.py ballast [--data-type delayed] [--glider-serial 63] [--mission-num 48]
+    python voto_cli.py serve [--meta-interval 3600] [--port 8787] [--log-file metadata_service.log]
+    python voto_cli.py import-time
+
+Only the standard library is imported at start-up. Each subcommand imports the modules it needs, so short jobs
+such as listing the cache do not pay for importing xarray, erddapy or matplotlib.
+"""
+import argparse
+import csv
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+# Modules reported by the import-time subcommand
+_timed_modules = ("voto_erddap_utils", "ballast_info", "metadata_tables", "request_planner", "attribute_tables",
+                  "metadata_service", "pandas", "xarray", "erddapy", "matplotlib.pyplot")
+
+
+def _datasets(args):
+    import voto_erddap_utils as utils
+    datasets = utils.find_glider_datasets(nrt_only=args.data_type == "nrt")
+    if args.data_type == "delayed":
+        datasets = [ds_id for ds_id in datasets if "delayed" in ds_id]
+    for ds_id in datasets:
+        print(ds_id)
+
+
+def _download(args):
+    import voto_erddap_utils as utils
+    glider_datasets = utils.download_glider_dataset(args.dataset_ids, variables=args.variables, adcp=args.adcp,
+                                                    cache_datasets=not args.no_cache)
+    for ds_id, ds in glider_datasets.items():
+        print(f"{ds_id}: {dict(ds.sizes)}, {len(ds.data_vars)} variables")
+
+
+def _cache(args):
+    cache_dir = Path(args.cache_dir)
+    cache_info = cache_dir / "cache_info.csv"
+    if not cache_info.exists():
+        print(f"no cache records file found in {cache_dir.absolute()}")
+        return
+    with open(cache_info, newline="") as file:
+        rows = list(csv.DictReader(file))
+    total_size = 0
+    for row in rows:
+        ds_id = row[""]
+        dataset_nc = cache_dir / f"{ds_id}.nc"
+        if dataset_nc.exists():
+            size = dataset_nc.stat().st_size
+            total_size += size
+            state = f"{size / 1e6:.1f} MB"
+        else:
+            state = "missing"
+        print(f"{ds_id}\t{row['date_created']}\t{state}")
+    print(f"{len(rows)} cached datasets, {total_size / 1e6:.1f} MB in {cache_dir.absolute()}")
+
+
+def _tables(args):
+    import metadata_tables
+    metadata_tables.meta_proc(processes=args.processes)
+
+
+def _ballast(args):
+    import ballast_info
+    import metadata_tables
+    missions = ballast_info.select_datasets(glider_serial=args.glider_serial, mission_num=args.mission_num,
+                                            data_type=args.data_type)
+    metadata_tables.proc_ballast(missions)
+
+
+def _serve(args):
+    import metadata_service
+    metadata_service.main(args.service_args)
+
+
+def _import_time(args):
+    # Each module is imported in a fresh interpreter so that the timings are not hidden by earlier imports
+    for module in args.modules or _timed_modules:
+        code = f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                                cwd=Path(__file__).parent)
+        if result.returncode:
+            print(f"{module:<20} failed: {result.stderr.strip().splitlines()[-1]}")
+        else:
+            print(f"{module:<20} {float(result.stdout) * 1000:8.1f} ms")
+
+
+def main(argv=None):
+    start = time.perf_counter()
+    parser = argparse.ArgumentParser(prog="voto_cli", description="Tools for VOTO glider datasets and metadata")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    datasets = subparsers.add_parser("datasets", help="list glider datasets on the VOTO ERDDAP")
+    datasets.add_argument("--data-type", choices=("nrt", "delayed", "all"), default="nrt")
+    datasets.set_defaults(func=_datasets)
+
+    download = subparsers.add_parser("download", help="download datasets to the cache")
+    download.add_argument("dataset_ids", nargs="+")
+    download.add_argument("--variables", nargs="+", default=(),
+                          help="data variables to download. If left empty, will download all variables")
+    download.add_argument("--adcp", action="store_true", help="add ADCP data where available")
+    download.add_argument("--no-cache", action="store_true", help="do not read from or write to the cache")
+    download.set_defaults(func=_download)
+
+    cache = subparsers.add_parser("cache", help="show the status of the dataset cache")
+    cache.add_argument("--cache-dir", default="voto_erddap_data_cache")
+    cache.set_defaults(func=_cache)
+
+    tables = subparsers.add_parser("tables", help="build and upload the metadata tables")
+    tables.add_argument("--processes", type=int,
+                        help="number of worker processes used to flatten metadata and attributes. Gives almost no "
+                             "speedup as the attributes are parsed in the main process")
+    tables.set_defaults(func=_tables)
+
+    ballast = subparsers.add_parser("ballast", help="add missing missions to the ballast table")
+    ballast.add_argument("--data-type", choices=("nrt", "delayed"), default="nrt")
+    ballast.add_argument("--glider-serial", type=int)
+    ballast.add_argument("--mission-num", type=int)
+    ballast.set_defaults(func=_ballast)
+
+    # The service options, including --help, are parsed by metadata_service so that they are declared in one place
+    serve = subparsers.add_parser("serve", help="run the metadata pipeline as a resident service", add_help=False)
+    serve.set_defaults(func=_serve)
+
+    import_time = subparsers.add_parser("import-time", help="measure the import time of the project modules")
+    import_time.add_argument("modules", nargs="*")
+    import_time.set_defaults(func=_import_time)
+
+    args, service_args = parser.parse_known_args(argv)
+    if args.command == "serve":
+        args.service_args = service_args
+    elif service_args:
+        parser.error(f"unrecognized arguments: {' '.join(service_args)}")
+    args.func(args)
+    if args.command != "serve":
+        print(f"{args.command} finished in {time.perf_counter() - start:.2f} s", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
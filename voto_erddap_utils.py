@@ -1,17 +1,20 @@
 import numpy as np
+import hashlib
 import pathlib
-import xarray as xr
-import pandas as pd
-import requests
-from erddapy import ERDDAP
-from tqdm import tqdm
 import xml.etree.ElementTree as ET
 from collections import defaultdict
+from attribute_tables import parse_attribute
+
+# pandas, xarray, erddapy, requests and tqdm are slow to import. They are imported inside the functions that use them
+# so that light-weight jobs, such as checking the cache, start quickly
 
 cache_dir = pathlib.Path('voto_erddap_data_cache')
+# In-memory copy of cache_info.csv, keyed on the file modification time
+_cache_index = {"mtime": None, "df": None}
 
 
 def init_erddap(protocol="tabledap"):
+    from erddapy import ERDDAP
     # Setup initial ERDDAP connection
     e = ERDDAP(
         server="https://erddap.observations.voiceoftheocean.org/erddap",
@@ -29,6 +32,7 @@ def _clean_dims(ds):
 
 
 def _get_meta_griddap(dataset_id):
+    import pandas as pd
     e = init_erddap(protocol="griddap")
     e.dataset_id = dataset_id
     e.griddap_initialize()
@@ -45,7 +49,7 @@ def _get_meta_griddap(dataset_id):
     for key, val in attrs.items():
         if type(val) == str:
             if "{" in val:
-                attrs[key] = eval(val)
+                attrs[key] = parse_attribute(val)
     if "basin" not in attrs.keys():
         attrs["basin"] = ""
     return attrs
@@ -93,13 +97,14 @@ def get_meta(dataset_id, protocol="tabledap"):
     for key, val in attrs.items():
         if type(val) == str:
             if "{" in val:
-                attrs[key] = eval(val)
+                attrs[key] = parse_attribute(val)
     if "basin" not in attrs.keys():
         attrs["basin"] = ""
     return attrs
 
 
 def date_from_iso(dataset_id):
+    import requests
     req = requests.get(f'https://erddap.observations.voiceoftheocean.org/erddap/tabledap/{dataset_id}.iso19115')
     with open('iso.xml', 'w') as file:
         file.write(req.text)
@@ -159,6 +164,146 @@ def add_profile_time(ds):
     return ds
 
 
+def _read_cache_index():
+    """
+    Read the cache records file. The table is kept in memory and only re-read when the file changes on disk
+    """
+    import pandas as pd
+    cache_info = cache_dir / "cache_info.csv"
+    mtime = cache_info.stat().st_mtime_ns
+    if _cache_index["mtime"] != mtime:
+        _cache_index["df"] = pd.read_csv(cache_info, index_col=0)
+        _cache_index["mtime"] = mtime
+    return _cache_index["df"].copy()
+
+
+# Navigation and engineering variables, i.e. everything that is not a science variable
+nav_variables = {'profile_index', 'rowSize', 'latitude', 'longitude', 'time', 'depth',
+                 'angular_cmd', 'angular_pos', 'ballast_cmd', 'ballast_pos', 'desired_heading',
+                 'dive_num', 'heading', 'internal_pressure', 'internal_temperature', 'linear_cmd',
+                 'linear_pos', 'nav_state', 'pitch', 'profile_direction', 'profile_num',
+                 'roll', 'security_level', 'vertical_distance_to_seafloor', 'voltage', 'declination'}
+
+grid_reducers = ("mean", "median", "count")
+
+
+def _grid_variables(ds):
+    return [var_name for var_name in ds.data_vars if var_name not in nav_variables
+            and ds[var_name].dims == ("time",) and np.issubdtype(ds[var_name].dtype, np.number)]
+
+
+def _gridded_cache_valid(dataset_nc, ds, gridding):
+    import xarray as xr
+    if not dataset_nc.exists():
+        return False
+    with xr.open_dataset(dataset_nc) as gridded:
+        return (gridded.attrs.get("gridding") == gridding
+                and str(gridded.attrs.get("date_created")) == str(ds.attrs["date_created"]))
+
+
+def grid_glider_dataset(ds, bin_edges=None, reducers=("mean",), variables=None, cache_gridded=True):
+    """
+    Bin science variables into a (profile x depth bin) grid.
+    ds: dataset with profile_num and profile_mean_time, as returned by add_profile_time
+    bin_edges: depth bin edges in m. Samples outside the edges are dropped. Defaults to 1 m bins covering all samples
+    reducers: any of "mean", "median" and "count". The mean keeps the variable name, the other reducers are added as
+    e.g. temperature_median and temperature_count
+    variables: variables to grid. If left empty, all numeric science variables are gridded
+    cache_gridded: if True, the gridded dataset is stored in the cache next to the raw dataset, as
+    <dataset_id>_gridded_<hash of the gridding options>.nc, and reused for as long as the raw dataset is unchanged
+    """
+    import xarray as xr
+    if "profile_num" not in ds or "profile_mean_time" not in ds:
+        raise ValueError("Dataset has no profile_num or profile_mean_time. Run add_profile_time first")
+    unknown = set(reducers).difference(grid_reducers)
+    if unknown:
+        raise ValueError(f"Unknown reducers {unknown}. Supported reducers are {grid_reducers}")
+    ds = _clean_dims(ds)
+    depth = ds.depth.values.astype(float)
+    if bin_edges is None:
+        bin_edges = np.arange(np.floor(np.nanmin(depth)), np.floor(np.nanmax(depth)) + 2)
+    bin_edges = np.asarray(bin_edges, dtype=float)
+    if not variables:
+        variables = _grid_variables(ds)
+    variables = list(variables)
+
+    gridding = str({"bin_edges": bin_edges.tolist(), "reducers": list(reducers), "variables": variables})
+    dataset_nc = None
+    if cache_gridded and "dataset_id" in ds.attrs and "date_created" in ds.attrs:
+        # One file per gridding configuration, so that different configurations do not evict each other
+        gridding_hash = hashlib.sha1(gridding.encode()).hexdigest()[:10]
+        dataset_nc = cache_dir / f"{ds.attrs['dataset_id']}_gridded_{gridding_hash}.nc"
+        if _gridded_cache_valid(dataset_nc, ds, gridding):
+            print(f"Found {dataset_nc}. Loading from disk")
+            # Loaded into memory so the file is closed and can be rewritten when the raw dataset changes
+            return xr.load_dataset(dataset_nc)
+
+    # Flat index of the (profile, depth bin) cell of every sample. Bins include their lower edge
+    profiles, first_sample, profile_cell = np.unique(ds.profile_num.values, return_index=True, return_inverse=True)
+    n_profiles = len(profiles)
+    n_bins = len(bin_edges) - 1
+    depth_bin = np.digitize(depth, bin_edges) - 1
+    in_grid = (depth_bin >= 0) & (depth_bin < n_bins)
+    cell = (profile_cell * n_bins + depth_bin)[in_grid]
+
+    # Sort the samples by cell once, then reduce every variable over the cell groups at the same time
+    order = np.argsort(cell, kind="stable")
+    cell = cell[order]
+    cells, starts = np.unique(cell, return_index=True)
+    values = np.column_stack([ds[var_name].values.astype(float) for var_name in variables]) \
+        if variables else np.empty((len(depth), 0))
+    values = values[in_grid][order]
+    valid = ~np.isnan(values)
+    count = np.zeros((n_profiles * n_bins, len(variables)), dtype=int)
+    reduced = {}
+    if len(cells):
+        count[cells] = np.add.reduceat(valid, starts, axis=0)
+    if "mean" in reducers:
+        sums = np.zeros(count.shape)
+        if len(cells):
+            sums[cells] = np.add.reduceat(np.where(valid, values, 0), starts, axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            reduced["mean"] = np.where(count > 0, sums / count, np.nan)
+    if "median" in reducers:
+        median = np.full(count.shape, np.nan)
+        for i in range(len(variables)):
+            # Within each cell, nan values are sorted after the valid ones
+            sorted_values = values[np.lexsort((values[:, i], cell)), i]
+            n_valid = count[cells, i]
+            has_data = n_valid > 0
+            low = (starts + (n_valid - 1) // 2)[has_data]
+            high = (starts + n_valid // 2)[has_data]
+            median[cells[has_data], i] = (sorted_values[low] + sorted_values[high]) / 2
+        reduced["median"] = median
+    if "count" in reducers:
+        reduced["count"] = count
+
+    centres = (bin_edges[:-1] + bin_edges[1:]) / 2
+    gridded = xr.Dataset(coords={
+        "profile_num": ("profile_num", profiles),
+        "profile_mean_time": ("profile_num", ds.profile_mean_time.values[first_sample]),
+        "depth": ("depth", centres, dict(ds.depth.attrs, bounds="depth_bnds")),
+    })
+    gridded["depth_bnds"] = (("depth", "nv"), np.column_stack((bin_edges[:-1], bin_edges[1:])))
+    for i, var_name in enumerate(variables):
+        for reducer in reducers:
+            name = var_name if reducer == "mean" else f"{var_name}_{reducer}"
+            attrs = dict(ds[var_name].attrs)
+            if reducer == "count":
+                attrs = {"long_name": f"number of {var_name} samples in bin", "units": "1"}
+            else:
+                attrs["cell_methods"] = f"depth: {reducer}"
+            gridded[name] = (("profile_num", "depth"), reduced[reducer][:, i].reshape(n_profiles, n_bins), attrs)
+    gridded.attrs = dict(ds.attrs)
+    gridded.attrs["gridding"] = gridding
+
+    if dataset_nc is not None:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        print(f"Writing {dataset_nc}")
+        gridded.to_netcdf(dataset_nc)
+    return gridded
+
+
 def _cached_dataset_exists(ds_id, request):
     """
     Returns True if all the following conditions are met:
@@ -167,6 +312,7 @@ def _cached_dataset_exists(ds_id, request):
     3. The dataset has not been updated on the VOTO ERDDAP since it was last downloaded
     Otherwise, returns False
     """
+    import pandas as pd
     if not cache_dir.exists():
         print(f"Creating directory to cache datasets at {cache_dir.absolute()}")
         pathlib.Path(cache_dir).mkdir(parents=True, exist_ok=True)
@@ -176,7 +322,7 @@ def _cached_dataset_exists(ds_id, request):
         print(f"Dataset {ds_id} not found in cache")
         return False
     try:
-        df = pd.read_csv(cache_dir / "cache_info.csv", index_col=0)
+        df = _read_cache_index()
     except:
         print(f"no cache records file found")
         return False
@@ -208,10 +354,12 @@ def _update_stats(ds_id, request):
     """
     Update the stats for a specified dataset
     """
+    import pandas as pd
+    import xarray as xr
     dataset_nc = cache_dir / f"{ds_id}.nc"
     ds = xr.open_dataset(dataset_nc)
     try:
-        df = pd.read_csv(cache_dir / "cache_info.csv", index_col=0)
+        df = _read_cache_index()
     except:
         df = pd.DataFrame()
 
@@ -228,6 +376,8 @@ def _update_stats(ds_id, request):
 
 
 def add_adcp_data(ds):
+    import pandas as pd
+    import xarray as xr
     dataset_id = ds.attrs["dataset_id"]
     parts = dataset_id.split("_")
     adcp_id = f"adcp_{parts[1]}_{parts[2]}"
@@ -242,7 +392,7 @@ def add_adcp_data(ds):
             print(f"Requested ADCP dataset {adcp_id} does not exist on server! Returning standard dataset")
             return ds
         print(f"Downloading {adcp_id}")
-        e = ERDDAP(server="https://erddap.observations.voiceoftheocean.org/erddap/", protocol="griddap", )
+        e = init_erddap(protocol="griddap")
         e.dataset_id = adcp_id
         e.griddap_initialize()
         time = pd.read_csv(f"https://erddap.observations.voiceoftheocean.org/erddap/griddap/{adcp_id}.csvp?time")[
@@ -272,6 +422,8 @@ def download_glider_dataset(dataset_ids, variables=(), constraints={}, nrt_only=
     dataset_ids: list of datasetIDs present on the VOTO ERDDAP
     variables: data variables to download. If left empty, will download all variables
     """
+    import xarray as xr
+    from tqdm import tqdm
     if nrt_only and delayed_only:
         raise ValueError("Cannot set both nrt_only and delayed_only")
     if nrt_only: